@@ -0,0 +1,327 @@
+# Home Assistant MQTT Auto Discovery for PiSQM
+# A single declarative entity schema drives both the Params payload and the discovery configs.
+# Discovery configs are serialized once and only re-published when their content changes.
+
+import hashlib
+import json
+import os
+import threading
+
+# Entity schema. "key" is the field in the Params JSON payload that the entity reads,
+# "round" (optional) is the number of decimals that field is published with.
+SENSORS = [
+    {
+        "id": "sqm",
+        "key": "sqm",
+        "name": "SQM",
+        "unit": "mpsas",
+        "stat_cla": "measurement",
+        "icon": "mdi:weather-night",
+        "round": 2
+    },
+    {
+        "id": "ina260_current",
+        "key": "ina260_current",
+        "name": "INA260 Current",
+        "unit": "A",
+        "stat_cla": "measurement",
+        "icon": "mdi:current-ac",
+        "round": 3
+    },
+    {
+        "id": "ina260_voltage",
+        "key": "ina260_voltage",
+        "name": "INA260 Voltage",
+        "unit": "V",
+        "stat_cla": "measurement",
+        "icon": "mdi:lightning-bolt",
+        "round": 3
+    },
+    {
+        "id": "ina260_power",
+        "key": "ina260_power",
+        "name": "INA260 Power",
+        "unit": "W",
+        "stat_cla": "measurement",
+        "icon": "mdi:power-plug",
+        "round": 3
+    },
+    {
+        "id": "ina260_voltage_min",
+        "key": "ina260_voltage_min",
+        "name": "INA260 Voltage Min",
+        "unit": "V",
+        "stat_cla": "measurement",
+        "icon": "mdi:lightning-bolt",
+        "round": 3
+    },
+    {
+        "id": "ina260_voltage_max",
+        "key": "ina260_voltage_max",
+        "name": "INA260 Voltage Max",
+        "unit": "V",
+        "stat_cla": "measurement",
+        "icon": "mdi:lightning-bolt",
+        "round": 3
+    },
+    {
+        "id": "ina260_voltage_avg",
+        "key": "ina260_voltage_avg",
+        "name": "INA260 Voltage Avg",
+        "unit": "V",
+        "stat_cla": "measurement",
+        "icon": "mdi:lightning-bolt",
+        "round": 3
+    },
+    {
+        "id": "ina260_current_min",
+        "key": "ina260_current_min",
+        "name": "INA260 Current Min",
+        "unit": "A",
+        "stat_cla": "measurement",
+        "icon": "mdi:current-ac",
+        "round": 3
+    },
+    {
+        "id": "ina260_current_max",
+        "key": "ina260_current_max",
+        "name": "INA260 Current Max",
+        "unit": "A",
+        "stat_cla": "measurement",
+        "icon": "mdi:current-ac",
+        "round": 3
+    },
+    {
+        "id": "ina260_current_avg",
+        "key": "ina260_current_avg",
+        "name": "INA260 Current Avg",
+        "unit": "A",
+        "stat_cla": "measurement",
+        "icon": "mdi:current-ac",
+        "round": 3
+    },
+    {
+        "id": "ina260_power_min",
+        "key": "ina260_power_min",
+        "name": "INA260 Power Min",
+        "unit": "W",
+        "stat_cla": "measurement",
+        "icon": "mdi:power-plug",
+        "round": 3
+    },
+    {
+        "id": "ina260_power_max",
+        "key": "ina260_power_max",
+        "name": "INA260 Power Max",
+        "unit": "W",
+        "stat_cla": "measurement",
+        "icon": "mdi:power-plug",
+        "round": 3
+    },
+    {
+        "id": "ina260_power_avg",
+        "key": "ina260_power_avg",
+        "name": "INA260 Power Avg",
+        "unit": "W",
+        "stat_cla": "measurement",
+        "icon": "mdi:power-plug",
+        "round": 3
+    },
+    {
+        "id": "ina260_energy",
+        "key": "ina260_energy",
+        "name": "INA260 Energy",
+        "unit": "Wh",
+        "dev_cla": "energy",
+        "stat_cla": "total_increasing",
+        "icon": "mdi:lightning-bolt-circle",
+        "round": 4
+    },
+    {
+        "id": "gain",
+        "key": "gain",
+        "name": "Sensor Gain",
+        "unit": "x",
+        "stat_cla": "measurement",
+        "icon": "mdi:brightness-6",
+        "ent_cat": "diagnostic"
+    },
+    {
+        "id": "integration_time",
+        "key": "integration_time_ms",
+        "name": "Integration Time",
+        "unit": "ms",
+        "stat_cla": "measurement",
+        "icon": "mdi:timer-outline",
+        "ent_cat": "diagnostic"
+    },
+    {
+        "id": "config_m0",
+        "key": "config_M0",
+        "name": "Config M0",
+        "unit": "mag",
+        "stat_cla": "measurement",
+        "icon": "mdi:variable",
+        "ent_cat": "diagnostic"
+    },
+    {
+        "id": "config_ga",
+        "key": "config_GA",
+        "name": "Config GA",
+        "unit": "mag",
+        "stat_cla": "measurement",
+        "icon": "mdi:variable",
+        "ent_cat": "diagnostic"
+    },
+    {
+        "id": "last_update",
+        "key": "timestamp",
+        "name": "Last Update",
+        "icon": "mdi:clock-outline",
+        "ent_cat": "diagnostic"
+    }
+]
+
+def build_params(values, sensors=SENSORS):
+    """
+    Builds the Params payload from raw values, in schema order.
+    Keys without a value (e.g. INA260 fields when the sensor is absent) are left out.
+    """
+    params = {}
+    for sensor in sensors:
+        key = sensor["key"]
+        if values.get(key) is None:
+            continue
+        value = values[key]
+        if "round" in sensor:
+            value = round(value, sensor["round"])
+        params[key] = value
+    return params
+
+class DiscoveryPublisher:
+    """
+    Publishes retained Home Assistant discovery configs, skipping any whose
+    content hash matches the one recorded after its last acknowledged publish.
+    Entities recorded in the state file but missing from the schema are removed
+    by publishing an empty retained config.
+    """
+
+    def __init__(self, discovery_prefix, node_id, device_info, state_topic,
+                 state_path, sensors=SENSORS):
+        self.discovery_prefix = discovery_prefix
+        self.state_path = state_path
+        self.status_topic = f"{discovery_prefix}/status"
+        self.lock = threading.Lock()
+        self.pending = {}  # mid -> (config topic, hash or None for removals)
+        self.published = self._load_state()
+
+        # Serialize every config once; the schema and device info do not change at runtime
+        self.configs = {}
+        for sensor in sensors:
+            topic = f"{discovery_prefix}/sensor/{node_id}/{sensor['id']}/config"
+            payload = json.dumps(self._build_config(sensor, node_id, device_info, state_topic))
+            self.configs[topic] = (payload, hashlib.sha256(payload.encode()).hexdigest())
+
+    @staticmethod
+    def _build_config(sensor, node_id, device_info, state_topic):
+        """Builds the discovery config for a single schema entry"""
+        payload = {
+            "name": sensor["name"],
+            "unique_id": f"{node_id}_{sensor['id']}",
+            "state_topic": state_topic,
+            "value_template": f"{{{{ value_json.{sensor['key']} }}}}",
+            "device": device_info
+        }
+
+        # Add optional fields if present
+        if "unit" in sensor:
+            payload["unit_of_measurement"] = sensor["unit"]
+        if "stat_cla" in sensor:
+            payload["state_class"] = sensor["stat_cla"]
+        if "icon" in sensor:
+            payload["icon"] = sensor["icon"]
+        if "dev_cla" in sensor:
+            payload["device_class"] = sensor["dev_cla"]
+        if "ent_cat" in sensor:
+            payload["entity_category"] = sensor["ent_cat"]
+        return payload
+
+    def on_status(self, client, userdata, msg):
+        """
+        MQTT callback for the Home Assistant birth topic.
+        Home Assistant (or a broker without retained state) coming back online
+        may have lost the configs, so resend all of them.
+        """
+        if msg.payload.decode(errors="replace") == "online":
+            print("Home Assistant came online, resending discovery configs")
+            self.invalidate()
+            self.publish(client)
+
+    def _load_state(self):
+        """Load the topic -> hash map of configs the broker has acknowledged"""
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+            if isinstance(state, dict):
+                return state
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"Discovery state unreadable, republishing all configs: {e}")
+        return {}
+
+    def _save_state(self, state):
+        """Write the state file atomically"""
+        try:
+            tmp_path = f"{self.state_path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.state_path)
+        except Exception as e:
+            print(f"File IO Error: {e}")
+
+    def invalidate(self):
+        """Forget all recorded hashes so the next publish() resends every config"""
+        with self.lock:
+            self.published = {topic: None for topic in self.published}
+
+    def publish(self, client):
+        """
+        Publishes changed configs and removes stale entities.
+        Hashes are recorded in on_publish() once the broker acknowledges them.
+        """
+        with self.lock:
+            self.pending.clear()
+            changed = [(topic, payload, digest) for topic, (payload, digest) in self.configs.items()
+                       if self.published.get(topic) != digest]
+            stale = [topic for topic in self.published if topic not in self.configs]
+
+            if not changed and not stale:
+                print("Home Assistant discovery configs unchanged, skipping publish")
+                return
+
+            print(f"Publishing Home Assistant discovery: {len(changed)} changed, {len(stale)} removed")
+            for topic, payload, digest in changed:
+                info = client.publish(topic, payload, qos=1, retain=True)
+                self.pending[info.mid] = (topic, digest)
+            for topic in stale:
+                # An empty retained config tells Home Assistant to delete the entity
+                info = client.publish(topic, "", qos=1, retain=True)
+                self.pending[info.mid] = (topic, None)
+
+    def on_publish(self, client, userdata, mid):
+        """MQTT on_publish callback: record acknowledged configs"""
+        with self.lock:
+            entry = self.pending.pop(mid, None)
+            if entry is None:
+                return
+            topic, digest = entry
+            if digest is None:
+                self.published.pop(topic, None)
+            else:
+                self.published[topic] = digest
+            # Persist once the whole batch has been acknowledged, sparing the SD card
+            if self.pending:
+                return
+            state = dict(self.published)
+        self._save_state(state)
@@ -0,0 +1,118 @@
+# Shared I2C bus manager for Raspberry Pi
+# One smbus2 handle per bus, shared by all sensor drivers, with serialized transactions,
+# retry with backoff on transient errors, and work scheduled into sensor wait periods.
+
+import collections
+import concurrent.futures
+import threading
+import time
+import smbus2
+
+# Retry settings for transient I2C errors (e.g. Errno 121 Remote I/O error)
+I2C_RETRIES = 3
+I2C_BACKOFF = 0.01  # Seconds before the first retry, doubled on each further attempt
+
+_buses = {}
+_buses_lock = threading.Lock()
+
+def get_bus(bus_id=1):
+    """
+    Returns the shared I2CBus for a bus number, opening it on first use.
+    Every caller should call close() on the returned bus when done with it.
+    """
+    with _buses_lock:
+        bus = _buses.get(bus_id)
+        if bus is None:
+            bus = I2CBus(bus_id)
+            _buses[bus_id] = bus
+        bus.users += 1
+        return bus
+
+class I2CBus:
+    """
+    Wraps a single smbus2.SMBus handle.
+    All transactions go through one lock so drivers on different threads never interleave.
+    """
+
+    def __init__(self, bus_id, retries=I2C_RETRIES, backoff=I2C_BACKOFF):
+        self.bus_id = bus_id
+        self.smbus = smbus2.SMBus(bus_id)
+        self.lock = threading.RLock()
+        self.retries = retries
+        self.backoff = backoff
+        self.users = 0
+        self.deferred = collections.deque()
+
+    def transaction(self, func, *args, retries=None):
+        """
+        Run one smbus2 call under the bus lock.
+        OSErrors are retried with exponential backoff (retries defaults to the
+        bus setting; 0 fails fast); the last one is raised.
+        The lock is released while backing off so other devices can use the bus.
+        """
+        retries = self.retries if retries is None else retries
+        delay = self.backoff
+        for attempt in range(retries + 1):
+            try:
+                with self.lock:
+                    return func(*args)
+            except OSError as e:
+                if attempt == retries:
+                    raise
+                print(f"I2C bus {self.bus_id} error: {e}, retrying in {delay * 1000:.0f}ms")
+                time.sleep(delay)
+                delay *= 2
+
+    def read_word_data(self, addr, reg, retries=None):
+        return self.transaction(self.smbus.read_word_data, addr, reg, retries=retries)
+
+    def write_byte_data(self, addr, reg, value, retries=None):
+        return self.transaction(self.smbus.write_byte_data, addr, reg, value, retries=retries)
+
+    def read_i2c_block_data(self, addr, reg, length, retries=None):
+        return self.transaction(self.smbus.read_i2c_block_data, addr, reg, length, retries=retries)
+
+    def write_i2c_block_data(self, addr, reg, data, retries=None):
+        return self.transaction(self.smbus.write_i2c_block_data, addr, reg, data, retries=retries)
+
+    def defer(self, func, *args):
+        """
+        Queue work to run during the next wait() (e.g. INA260 reads while the
+        TSL2591 integrates). Returns a Future holding the result.
+        """
+        future = concurrent.futures.Future()
+        self.deferred.append((future, func, args))
+        return future
+
+    def run_deferred(self, deadline=None):
+        """Run queued work, stopping early once the monotonic deadline has passed"""
+        while self.deferred:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            future, func, args = self.deferred.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+    def wait(self, seconds):
+        """
+        Sleep for a period where the caller does not need the bus, running
+        deferred work first. A job that overruns only delays the caller's
+        next read; the sensor keeps integrating in hardware meanwhile.
+        """
+        deadline = time.monotonic() + seconds
+        self.run_deferred(deadline)
+        remaining = deadline - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def close(self):
+        """Release this user's reference, closing the handle when it was the last one"""
+        with _buses_lock:
+            self.users -= 1
+            if self.users <= 0:
+                self.smbus.close()
+                _buses.pop(self.bus_id, None)
@@ -1,7 +1,108 @@
 
-import smbus2
+import i2c_bus
+import threading
 import time
 
+# Statistics are kept as per-bucket min/max/sum so memory stays bounded at any sample rate
+STATS_BUCKET_SECONDS = 60
+STATS_WINDOW_SECONDS = 24 * 3600
+
+# Sampler gaps longer than this many sample periods are left out of the energy total,
+# and a latest reading older than this is treated as stale
+ENERGY_MAX_GAP_PERIODS = 10
+
+class PowerStats:
+    """
+    Downsampled 24 h statistics and energy total for INA260 readings.
+    Kept separate from the driver so recorded readings can be replayed without hardware.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.readings = []   # Downsampled statistics buckets, oldest first
+        self.latest = {}
+        self.energy_wh = 0.0
+        self.last_sample = None  # (clock, power) of the previous reading
+
+    def add(self, reading, timestamp=None, clock=None, max_gap=None):
+        """
+        Integrate energy and fold the reading into its statistics bucket.
+        timestamp (wall time) places the bucket and clock (monotonic) times the
+        energy integration; both default to now. A gap longer than max_gap
+        seconds since the previous reading is not integrated.
+        """
+        now = time.time() if timestamp is None else timestamp
+        mono = time.monotonic() if clock is None else clock
+        bucket_start = now - (now % STATS_BUCKET_SECONDS)
+
+        with self.lock:
+            # Trapezoidal integration of power over time
+            if self.last_sample is not None:
+                last_time, last_power = self.last_sample
+                if max_gap is None or mono - last_time <= max_gap:
+                    self.energy_wh += (last_power + reading["power"]) / 2 * (mono - last_time) / 3600
+            self.last_sample = (mono, reading["power"])
+            self.latest = dict(reading)
+
+            if not self.readings or self.readings[-1]["timestamp"] != bucket_start:
+                bucket = {"timestamp": bucket_start, "count": 0}
+                for name, value in reading.items():
+                    bucket[f"{name}_min"] = value
+                    bucket[f"{name}_max"] = value
+                    bucket[f"{name}_sum"] = 0.0
+                self.readings.append(bucket)
+
+            bucket = self.readings[-1]
+            bucket["count"] += 1
+            for name, value in reading.items():
+                bucket[f"{name}_min"] = min(bucket[f"{name}_min"], value)
+                bucket[f"{name}_max"] = max(bucket[f"{name}_max"], value)
+                bucket[f"{name}_sum"] += value
+
+    def get_latest(self, max_age=None, clock=None):
+        """
+        Returns the most recent reading (empty until the first one), or empty
+        once it is more than max_age seconds older than clock (default: now).
+        """
+        mono = time.monotonic() if clock is None else clock
+        with self.lock:
+            if max_age is not None and self.last_sample is not None and mono - self.last_sample[0] > max_age:
+                return {}
+            return dict(self.latest)
+
+    def get_metrics(self, now=None):
+        """
+        Returns min/max/avg over the 24 hours before now (default: current time)
+        and the energy in Wh accumulated since start or the last reset.
+        """
+        cutoff = (time.time() if now is None else now) - STATS_WINDOW_SECONDS
+
+        with self.lock:
+            # Prune buckets older than the window
+            self.readings = [b for b in self.readings if b["timestamp"] > cutoff]
+            recent_buckets = self.readings
+            energy_wh = self.energy_wh
+
+            if not recent_buckets:
+                return {}
+
+            count = sum(b["count"] for b in recent_buckets)
+            metrics = {}
+            for name in ("voltage", "current", "power"):
+                metrics[f"{name}_min"] = min(b[f"{name}_min"] for b in recent_buckets)
+                metrics[f"{name}_max"] = max(b[f"{name}_max"] for b in recent_buckets)
+                metrics[f"{name}_avg"] = sum(b[f"{name}_sum"] for b in recent_buckets) / count
+
+        metrics["energy"] = energy_wh
+        return metrics
+
+    def reset(self):
+        """Clears all statistics and the energy total"""
+        with self.lock:
+            self.readings = []
+            self.energy_wh = 0.0
+            self.last_sample = None
+
 class INA260:
     """
     Simple INA260 Power Monitor Reader
@@ -10,28 +111,44 @@ class INA260:
 
     INA260_ADDR = 0x40
 
+    REG_CONFIG = 0x00       # Configuration register (averaging, conversion times, mode)
     REG_CURRENT = 0x01      # Current register (LSB = 1.25 mA)
     REG_VOLTAGE = 0x02      # Bus voltage register (LSB = 1.25 mV)
     REG_POWER = 0x03        # Power register (LSB = 10 mW)
     REG_MFG_ID = 0xFE       # Manufacturer ID (should be 0x5449 = "TI")
     REG_DIE_ID = 0xFF       # Die ID (should be 0x2270 for INA260)
 
+    # Averaging modes (CONFIG bits 11-9), keyed by number of averages
+    AVERAGES = {1: 0, 4: 1, 16: 2, 64: 3, 128: 4, 256: 5, 512: 6, 1024: 7}
+
+    # Conversion times (CONFIG bits 8-6 for voltage, 5-3 for current), keyed by microseconds
+    CONVERSION_TIMES = {140: 0, 204: 1, 332: 2, 588: 3, 1100: 4, 2116: 5, 4156: 6, 8244: 7}
+
+    MODE_CONTINUOUS = 0x7   # Continuous current and voltage conversions
+
     def __init__(self, bus=1):
-        self.bus = smbus2.SMBus(bus)
-        self.readings = []
+        self.bus = i2c_bus.get_bus(bus)  # Shared handle, see i2c_bus.py
+        self.stats = PowerStats()
+        self.sampler = None
+        self.stop_event = threading.Event()
+        self.max_gap = None  # Longest gap (s) integrated into energy or served as latest, set by start_sampling()
 
-    def _read_register(self, reg):
+    def _read_register(self, reg, retries=None):
         """Read a 16-bit register (big-endian)"""
-        data = self.bus.read_i2c_block_data(self.INA260_ADDR, reg, 2)
+        data = self.bus.read_i2c_block_data(self.INA260_ADDR, reg, 2, retries=retries)
         return (data[0] << 8) | data[1]
 
-    def _read_signed_register(self, reg):
+    def _read_signed_register(self, reg, retries=None):
         """Read a signed 16-bit register"""
-        value = self._read_register(reg)
+        value = self._read_register(reg, retries)
         if value >= 0x8000:
             value -= 0x10000
         return value
 
+    def _write_register(self, reg, value):
+        """Write a 16-bit register (big-endian)"""
+        self.bus.write_i2c_block_data(self.INA260_ADDR, reg, [(value >> 8) & 0xFF, value & 0xFF])
+
     def check_id(self):
         """Verify we're talking to an INA260"""
         mfg_id = self._read_register(self.REG_MFG_ID)
@@ -39,69 +156,132 @@ class INA260:
         if mfg_id != 0x5449 or die_id != 0x2270:
             raise RuntimeError("Failed to find INA260 chip")
 
-    def read(self):
+    def configure(self, averages=1, conversion_time_us=1100):
+        """
+        Set hardware averaging and conversion time for both channels (continuous mode).
+        Each register update then covers averages * 2 * conversion_time_us.
+        """
+        if averages not in self.AVERAGES:
+            raise ValueError(f"Unsupported INA260 averaging: {averages}")
+        if conversion_time_us not in self.CONVERSION_TIMES:
+            raise ValueError(f"Unsupported INA260 conversion time: {conversion_time_us}us")
+
+        ct = self.CONVERSION_TIMES[conversion_time_us]
+        config = (self.AVERAGES[averages] << 9) | (ct << 6) | (ct << 3) | self.MODE_CONTINUOUS
+        self._write_register(self.REG_CONFIG, config)
+
+    def read(self, retries=None):
         """
         Reads the current, voltage and power from the INA260 sensor.
+        retries overrides the bus retry count for transient I2C errors.
         """
         # Read raw values
-        voltage_raw = self._read_register(self.REG_VOLTAGE)
-        current_raw = self._read_signed_register(self.REG_CURRENT)
-        power_raw = self._read_register(self.REG_POWER)
+        voltage_raw = self._read_register(self.REG_VOLTAGE, retries)
+        current_raw = self._read_signed_register(self.REG_CURRENT, retries)
+        power_raw = self._read_register(self.REG_POWER, retries)
 
         # Convert to real units
         voltage = voltage_raw * 1.25 / 1000    # Convert to Volts
         current = current_raw * 1.25 / 1000   # Convert to Amps
         power = power_raw * 10 / 1000         # Convert to Watts
 
-        # Store reading
-        self.readings.append({
-            "timestamp": time.time(),
-            "voltage": voltage,
-            "current": current,
-            "power": power
-        })
-
-        return {
+        reading = {
             "current": current,
             "voltage": voltage,
             "power": power
         }
+        self.stats.add(reading, max_gap=self.max_gap)
+        return reading
+
+    def get_latest(self):
+        """
+        Returns the most recent reading (empty until the first one).
+        While sampling, a reading older than max_gap counts as stale and is not returned.
+        """
+        return self.stats.get_latest(max_age=self.max_gap)
 
     def get_metrics(self):
         """
-        Returns a dictionary with all the metrics for the last 24 hours.
+        Returns a dictionary with all the metrics for the last 24 hours,
+        plus the energy in Wh accumulated since start or the last reset.
+        """
+        return self.stats.get_metrics()
+
+    def reset_metrics(self):
+        """
+        Resets all the metrics, including accumulated energy.
         """
-        now = time.time()
-        twenty_four_hours_ago = now - (24 * 3600)
+        self.stats.reset()
 
-        # Filter readings for the last 24 hours
-        recent_readings = [r for r in self.readings if r["timestamp"] > twenty_four_hours_ago]
-        self.readings = recent_readings # Prune old readings
+    def start_sampling(self, rate_hz, averages=None, conversion_time_us=None):
+        """
+        Poll the sensor from a background thread at rate_hz.
+        Unless given, averaging and conversion time are picked so each reading
+        covers as much of the sample period as possible; spikes between polls then
+        still count towards the averages and the energy total.
+        """
+        period = 1.0 / rate_hz
+        if averages is None:
+            # Largest averages x (voltage + current conversion) window that fits the period
+            fits = [(n * 2 * ct, n, ct) for n in self.AVERAGES for ct in self.CONVERSION_TIMES
+                    if n * 2 * ct * 1e-6 <= period]
+            _, averages, conversion_time_us = max(fits, default=(0, 1, 140))
+        elif conversion_time_us is None:
+            conversion_time_us = 1100
+        self.configure(averages, conversion_time_us)
 
-        if not recent_readings:
-            return {}
+        # Don't bridge outages (e.g. after failed reads) at the last known power,
+        # or keep serving the last reading as current
+        self.max_gap = ENERGY_MAX_GAP_PERIODS * period
 
-        voltages = [r["voltage"] for r in recent_readings]
-        currents = [r["current"] for r in recent_readings]
-        powers = [r["power"] for r in recent_readings]
+        self.stop_event.clear()
+        self.sampler = threading.Thread(target=self._sample_loop, args=(period,),
+                                        name="ina260-sampler", daemon=True)
+        self.sampler.start()
+        print(f"INA260 sampling at {rate_hz}Hz with {averages}x hardware averaging "
+              f"at {conversion_time_us}us conversion time")
 
-        return {
-            "voltage_min": min(voltages),
-            "voltage_max": max(voltages),
-            "voltage_avg": sum(voltages) / len(voltages),
-            "current_min": min(currents),
-            "current_max": max(currents),
-            "current_avg": sum(currents) / len(currents),
-            "power_min": min(powers),
-            "power_max": max(powers),
-            "power_avg": sum(powers) / len(powers),
-        }
+    def _sample_loop(self, period):
+        next_time = time.monotonic()
+        failing = False
+        while not self.stop_event.is_set():
+            try:
+                # No bus retries: the next sample is only one period away, and
+                # retrying a disconnected sensor would flood the journal
+                self.read(retries=0)
+                if failing:
+                    print("INA260 sampling recovered")
+                failing = False
+            except Exception as e:
+                # Only log the first failure in a row to avoid flooding the journal
+                if not failing:
+                    print(f"INA260 sample failed: {e}")
+                failing = True
 
-    def reset_metrics(self):
+            next_time += period
+            delay = next_time - time.monotonic()
+            if delay < 0:
+                # Fell behind (e.g. long bus retries), skip missed samples rather than bursting
+                next_time = time.monotonic()
+                delay = 0
+            self.stop_event.wait(delay)
+
+    @property
+    def sampling(self):
+        """True while the background sampler is running"""
+        return self.sampler is not None and self.sampler.is_alive()
+
+    def stop_sampling(self, timeout=1.0):
         """
-        Resets all the metrics.
+        Stop the background sampler, waiting at most timeout seconds for it.
+        The wait is bounded because a caller interrupted by a signal may hold the
+        bus lock the sampler is blocked on; the daemon thread dies with the process.
         """
-        self.readings = []
+        self.stop_event.set()
+        if self.sampler is not None:
+            self.sampler.join(timeout)
+            self.sampler = None
 
     def close(self):
+        self.stop_sampling()
         self.bus.close()
@@ -3,6 +3,7 @@
 
 import tsl2591
 import ina260
+import ha_discovery
 import time
 import math
 import paho.mqtt.client as mqtt
@@ -28,238 +29,114 @@ DEVICE_INFO = {
     "manufacturer": "DIY",
     "sw_version": "1.1"
 }
+# Hashes of the discovery configs the broker has acknowledged, so reconnects only resend changes
+HA_DISCOVERY_STATE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ha_discovery_state.json")
 
 # Global Configuration Variables (Can be updated via MQTT)
 # M = M0 + GA - 2.5 * log10(Counts)
 M0 = -16.07       # Magnitude Zero Point
 GA = 28.02        # Glass Attenuation
 MEASURE_INTERVAL = 10 # Seconds between readings
+INA260_SAMPLE_RATE = 10 # Hz, background INA260 polling (0 = read once per measurement)
 
-# Initialize the TSL2591 sensor
-try:
-    print("Initializing TSL2591...")
-    # Initialize with default medium settings, auto-ranging will adjust
-    tsl = tsl2591.Tsl2591(1, tsl2591.INTEGRATIONTIME_200MS, tsl2591.GAIN_MED)
-except Exception as e:
-    print(f"Failed to initialize TSL2591 sensor: {e}")
-    sys.exit(1)
-
-# Initialize the INA260 sensor
-try:
-    print("Initializing INA260...")
-    ina = ina260.INA260()
-    ina.check_id()
-except Exception as e:
-    print(f"Failed to initialize INA260 sensor: {e}")
-    # Continue without the INA260 sensor
-    ina = None
-
-def publish_ha_discovery(client):
+# Allsky overlay file for the current SQM value
+ALLSKY_JSON_PATH = "/home/pi/allsky/config/overlay/extra/allskytsl2591SQM.json"
+
+# Append every raw reading as a JSON line for replay.py (None = disabled)
+RAW_LOG_FILE = None
+
+# Set in main(); module level so the MQTT callbacks and signal handler can reach them
+tsl = None
+ina = None
+client = None
+discovery = None
+
+def calculate_mpsas(full, ir, gain, integration):
     """
-    Publishes Home Assistant Auto Discovery payloads for all sensors.
+    Calculate sky brightness (MPSAS) from raw TSL2591 counts.
     """
-    print("Publishing Home Assistant Auto Discovery payloads...")
-    
-    sensors = [
-        {
-            "id": "sqm",
-            "name": "SQM",
-            "stat_t": TOPIC_PUB_PARAMS,
-            "val_tpl": "{{ value_json.sqm }}",
-            "unit": "mpsas",
-            "stat_cla": "measurement",
-            "icon": "mdi:weather-night"
-        },
-        {
-            "id": "ina260_current",
-            "name": "INA260 Current",
-            "stat_t": TOPIC_PUB_PARAMS,
-            "val_tpl": "{{ value_json.ina260_current }}",
-            "unit": "A",
-            "stat_cla": "measurement",
-            "icon": "mdi:current-ac"
-        },
-        {
-            "id": "ina260_voltage",
-            "name": "INA260 Voltage",
-            "stat_t": TOPIC_PUB_PARAMS,
-            "val_tpl": "{{ value_json.ina260_voltage }}",
-            "unit": "V",
-            "stat_cla": "measurement",
-            "icon": "mdi:lightning-bolt"
-        },
-        {
-            "id": "ina260_power",
-            "name": "INA260 Power",
-            "stat_t": TOPIC_PUB_PARAMS,
-            "val_tpl": "{{ value_json.ina260_power }}",
-            "unit": "W",
-            "stat_cla": "measurement",
-            "icon": "mdi:power-plug"
-        },
-        {
-            "id": "ina260_voltage_min",
-            "name": "INA260 Voltage Min",
-            "stat_t": TOPIC_PUB_PARAMS,
-            "val_tpl": "{{ value_json.ina260_voltage_min }}",
-            "unit": "V",
-            "stat_cla": "measurement",
-            "icon": "mdi:lightning-bolt"
-        },
-        {
-            "id": "ina260_voltage_max",
-            "name": "INA260 Voltage Max",
-            "stat_t": TOPIC_PUB_PARAMS,
-            "val_tpl": "{{ value_json.ina260_voltage_max }}",
-            "unit": "V",
-            "stat_cla": "measurement",
-            "icon": "mdi:lightning-bolt"
-        },
-        {
-            "id": "ina260_voltage_avg",
-            "name": "INA260 Voltage Avg",
-            "stat_t": TOPIC_PUB_PARAMS,
-            "val_tpl": "{{ value_json.ina260_voltage_avg }}",
-            "unit": "V",
-            "stat_cla": "measurement",
-            "icon": "mdi:lightning-bolt"
-        },
-        {
-            "id": "ina260_current_min",
-            "name": "INA260 Current Min",
-            "stat_t": TOPIC_PUB_PARAMS,
-            "val_tpl": "{{ value_json.ina260_current_min }}",
-            "unit": "A",
-            "stat_cla": "measurement",
-            "icon": "mdi:current-ac"
-        },
-        {
-            "id": "ina260_current_max",
-            "name": "INA260 Current Max",
-            "stat_t": TOPIC_PUB_PARAMS,
-            "val_tpl": "{{ value_json.ina260_current_max }}",
-            "unit": "A",
-            "stat_cla": "measurement",
-            "icon": "mdi:current-ac"
-        },
-        {
-            "id": "ina260_current_avg",
-            "name": "INA260 Current Avg",
-            "stat_t": TOPIC_PUB_PARAMS,
-            "val_tpl": "{{ value_json.ina260_current_avg }}",
-            "unit": "A",
-            "stat_cla": "measurement",
-            "icon": "mdi:current-ac"
-        },
-        {
-            "id": "ina260_power_min",
-            "name": "INA260 Power Min",
-            "stat_t": TOPIC_PUB_PARAMS,
-            "val_tpl": "{{ value_json.ina260_power_min }}",
-            "unit": "W",
-            "stat_cla": "measurement",
-            "icon": "mdi:power-plug"
-        },
-        {
-            "id": "ina260_power_max",
-            "name": "INA260 Power Max",
-            "stat_t": TOPIC_PUB_PARAMS,
-            "val_tpl": "{{ value_json.ina260_power_max }}",
-            "unit": "W",
-            "stat_cla": "measurement",
-            "icon": "mdi:power-plug"
-        },
-        {
-            "id": "ina260_power_avg",
-            "name": "INA260 Power Avg",
-            "stat_t": TOPIC_PUB_PARAMS,
-            "val_tpl": "{{ value_json.ina260_power_avg }}",
-            "unit": "W",
-            "stat_cla": "measurement",
-            "icon": "mdi:power-plug"
-        },
-        {
-            "id": "gain",
-            "name": "Sensor Gain",
-            "stat_t": TOPIC_PUB_PARAMS,
-            "val_tpl": "{{ value_json.gain }}",
-            "unit": "x",
-            "stat_cla": "measurement",
-            "icon": "mdi:brightness-6",
-            "ent_cat": "diagnostic"
-        },
-        {
-            "id": "integration_time",
-            "name": "Integration Time",
-            "stat_t": TOPIC_PUB_PARAMS,
-            "val_tpl": "{{ value_json.integration_time_ms }}",
-            "unit": "ms",
-            "stat_cla": "measurement",
-            "icon": "mdi:timer-outline",
-            "ent_cat": "diagnostic"
-        },
-        {
-            "id": "config_m0",
-            "name": "Config M0",
-            "stat_t": TOPIC_PUB_PARAMS,
-            "val_tpl": "{{ value_json.config_M0 }}",
-            "unit": "mag",
-            "stat_cla": "measurement",
-            "icon": "mdi:variable",
-            "ent_cat": "diagnostic"
-        },
-        {
-            "id": "config_ga",
-            "name": "Config GA",
-            "stat_t": TOPIC_PUB_PARAMS,
-            "val_tpl": "{{ value_json.config_GA }}",
-            "unit": "mag",
-            "stat_cla": "measurement",
-            "icon": "mdi:variable",
-            "ent_cat": "diagnostic"
-        },
-        {
-            "id": "last_update",
-            "name": "Last Update",
-            "stat_t": TOPIC_PUB_PARAMS,
-            "val_tpl": "{{ value_json.timestamp }}",
-            "icon": "mdi:clock-outline",
-            "ent_cat": "diagnostic"
-        }
-    ]
+    # Calculate flux in uW/cm2
+    full_C, ir_C = tsl2591.calculate_light(full, ir, gain, integration)
 
-    for sensor in sensors:
-        unique_id = f"{HA_NODE_ID}_{sensor['id']}"
-        topic = f"{HA_DISCOVERY_PREFIX}/sensor/{HA_NODE_ID}/{sensor['id']}/config"
-        
-        payload = {
-            "name": sensor["name"],
-            "unique_id": unique_id,
-            "state_topic": sensor["stat_t"],
-            "value_template": sensor["val_tpl"],
-            "device": DEVICE_INFO
+    flux_diff = full_C - ir_C
+    if flux_diff > 0:
+        return M0 + GA - 2.5 * math.log10(flux_diff)
+    return 25.0 # Typical dark limit convention
+
+def write_allsky(mpsas_msg, json_path=ALLSKY_JSON_PATH):
+    """
+    Write SQM value to the Allsky overlay JSON file.
+    """
+    sqm_data = {"AS_MPSAS": float(mpsas_msg)}
+
+    # Create directory if it doesn't exist
+    try:
+        os.makedirs(os.path.dirname(json_path), exist_ok=True)
+        # Write atomically so readers (Allsky overlay / publishdata) never
+        # see a zero-byte or partially-written file.
+        tmp_path = f"{json_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(sqm_data, f)
+        os.replace(tmp_path, json_path)
+    except Exception as e:
+        print(f"File IO Error: {e}")
+
+def process_reading(mqtt_client, record, ina_metrics=None, allsky_path=ALLSKY_JSON_PATH):
+    """
+    Runs one raw reading through computation, MQTT publishing and the Allsky file.
+    record: {"timestamp", "full", "ir", "gain", "integration"} plus an optional
+    "ina260" {"current", "voltage", "power"} reading, as written to RAW_LOG_FILE.
+    Returns the formatted MPSAS string.
+    """
+    mpsas = calculate_mpsas(record["full"], record["ir"], record["gain"], record["integration"])
+
+    # Format and publish messages
+    mpsas_msg = f"{mpsas:.2f}"
+    timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record["timestamp"]))
+
+    if mqtt_client.is_connected():
+        mqtt_client.publish(TOPIC_PUB, mpsas_msg, retain=True)
+
+        # Publish Params
+        values = {
+            "sqm": mpsas,
+            "gain": record["gain"],
+            "integration_time_ms": tsl2591.int_time_ms(record["integration"]),
+            "timestamp": timestamp,
+            "config_M0": M0,
+            "config_GA": GA
         }
-        
-        # Add optional fields if present
-        if "unit" in sensor:
-            payload["unit_of_measurement"] = sensor["unit"]
-        if "stat_cla" in sensor:
-            payload["state_class"] = sensor["stat_cla"]
-        if "icon" in sensor:
-            payload["icon"] = sensor["icon"]
-        if "dev_cla" in sensor:
-            payload["device_class"] = sensor["dev_cla"]
-        if "ent_cat" in sensor:
-            payload["entity_category"] = sensor["ent_cat"]
-
-        client.publish(topic, json.dumps(payload), retain=True)
+        ina_data = record.get("ina260")
+        if ina_data:
+            values["ina260_current"] = ina_data["current"]
+            values["ina260_voltage"] = ina_data["voltage"]
+            values["ina260_power"] = ina_data["power"]
+
+        # Metric names map onto the schema as ina260_<metric>
+        for name, value in (ina_metrics or {}).items():
+            values[f"ina260_{name}"] = value
+
+        params_data = ha_discovery.build_params(values)
+        mqtt_client.publish(TOPIC_PUB_PARAMS, json.dumps(params_data), retain=True)
+
+    write_allsky(mpsas_msg, allsky_path)
+    return mpsas_msg
+
+def log_raw(record, path):
+    """Append a raw reading to the replay log"""
+    try:
+        with open(path, 'a') as f:
+            f.write(json.dumps(record) + "\n")
+    except Exception as e:
+        print(f"File IO Error: {e}")
 
 # MQTT callbacks
 def on_connect(client, userdata, flags, rc):
     print(f"Connected to MQTT broker with result code {rc}")
     client.subscribe(TOPIC_SUB)
-    # Publish HA Discovery on connect/reconnect
-    publish_ha_discovery(client)
+    client.subscribe(discovery.status_topic)
+    # Publish changed HA Discovery configs on connect/reconnect
+    discovery.publish(client)
 
 def on_message(client, userdata, msg):
     """
@@ -301,106 +178,104 @@ def on_disconnect(client, userdata, rc):
         except Exception as e:
             print(f"Failed to reconnect: {e}")
 
-# Setup MQTT client
-client = mqtt.Client()
-client.on_connect = on_connect
-client.on_message = on_message
-client.on_disconnect = on_disconnect
-
-# Connect to MQTT broker
-try:
-    client.connect(MQTT_SERVER, 1883, 60)
-    client.loop_start()
-except Exception as e:
-    print(f"Failed to connect to MQTT broker: {e}")
-    print("Continuing without MQTT...")
-
 # Handle graceful shutdown
 def signal_handler(signum, frame):
     print("\nShutting down...")
+    if ina:
+        ina.stop_sampling()
     client.loop_stop()
     client.disconnect()
     sys.exit(0)
 
-signal.signal(signal.SIGINT, signal_handler)
-signal.signal(signal.SIGTERM, signal_handler)
+def main():
+    global tsl, ina, client, discovery
 
-# Main loop
-print("Starting auto-ranging measurement loop...")
-while True:
+    # Initialize the TSL2591 sensor
     try:
-        # Read sensor data with Auto-Ranging
-        full, ir = tsl.advanced_read()
-        
-        # Calculate flux in uW/cm2
-        full_C, ir_C = tsl.calculate_light(full, ir)
-        
-        # Calculate sky brightness (MPSAS)
-        flux_diff = full_C - ir_C
-        if flux_diff > 0:
-            mpsas = M0 + GA - 2.5 * math.log10(flux_diff)
-        else:
-            mpsas = 25.0 # Typical dark limit convention
-            
-        # Format and publish messages
-        mpsas_msg = f"{mpsas:.2f}"
-        timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
-        
-        if client.is_connected():
-            client.publish(TOPIC_PUB, mpsas_msg, retain=True)
-            
-            # Publish Params
-            params_data = {
-                "sqm": float(mpsas_msg),
+        print("Initializing TSL2591...")
+        # Initialize with default medium settings, auto-ranging will adjust
+        tsl = tsl2591.Tsl2591(1, tsl2591.INTEGRATIONTIME_200MS, tsl2591.GAIN_MED)
+    except Exception as e:
+        print(f"Failed to initialize TSL2591 sensor: {e}")
+        sys.exit(1)
+
+    # Initialize the INA260 sensor
+    try:
+        print("Initializing INA260...")
+        ina = ina260.INA260()
+        ina.check_id()
+        if INA260_SAMPLE_RATE > 0:
+            ina.start_sampling(INA260_SAMPLE_RATE)
+    except Exception as e:
+        print(f"Failed to initialize INA260 sensor: {e}")
+        # Continue without the INA260 sensor
+        ina = None
+
+    discovery = ha_discovery.DiscoveryPublisher(
+        HA_DISCOVERY_PREFIX, HA_NODE_ID, DEVICE_INFO, TOPIC_PUB_PARAMS, HA_DISCOVERY_STATE_FILE
+    )
+
+    # Setup MQTT client
+    client = mqtt.Client()
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.on_disconnect = on_disconnect
+    client.on_publish = discovery.on_publish
+    client.message_callback_add(discovery.status_topic, discovery.on_status)
+
+    # Connect to MQTT broker
+    try:
+        client.connect(MQTT_SERVER, 1883, 60)
+        client.loop_start()
+    except Exception as e:
+        print(f"Failed to connect to MQTT broker: {e}")
+        print("Continuing without MQTT...")
+
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+
+    # Main loop
+    print("Starting auto-ranging measurement loop...")
+    while True:
+        try:
+            # Without background sampling, schedule the INA260 read into the
+            # TSL2591 integration wait on the shared bus
+            ina_future = tsl.bus.defer(ina.read) if ina and not ina.sampling else None
+
+            # Read sensor data with Auto-Ranging
+            try:
+                full, ir = tsl.advanced_read()
+            finally:
+                # Run anything the integration wait did not get to
+                tsl.bus.run_deferred()
+
+            record = {
+                "timestamp": time.time(),
+                "full": full,
+                "ir": ir,
                 "gain": tsl.gain,
-                "integration_time_ms": tsl.get_int_time_ms(),
-                "timestamp": timestamp,
-                "config_M0": M0,
-                "config_GA": GA
+                "integration": tsl.integration_time
             }
+            ina_metrics = None
             if ina:
                 try:
-                    ina_data = ina.read()
-                    params_data["ina260_current"] = round(ina_data["current"], 3)
-                    params_data["ina260_voltage"] = round(ina_data["voltage"], 3)
-                    params_data["ina260_power"] = round(ina_data["power"], 3)
-
-                    metrics = ina.get_metrics()
-                    if metrics:
-                        params_data["ina260_current_avg"] = round(metrics["current_avg"], 3)
-                        params_data["ina260_current_min"] = round(metrics["current_min"], 3)
-                        params_data["ina260_current_max"] = round(metrics["current_max"], 3)
-                        params_data["ina260_voltage_avg"] = round(metrics["voltage_avg"], 3)
-                        params_data["ina260_voltage_min"] = round(metrics["voltage_min"], 3)
-                        params_data["ina260_voltage_max"] = round(metrics["voltage_max"], 3)
-                        params_data["ina260_power_avg"] = round(metrics["power_avg"], 3)
-                        params_data["ina260_power_min"] = round(metrics["power_min"], 3)
-                        params_data["ina260_power_max"] = round(metrics["power_max"], 3)
-
+                    ina_data = ina_future.result() if ina_future else ina.get_latest()
+                    if ina_data:
+                        record["ina260"] = ina_data
+                    ina_metrics = ina.get_metrics()
                 except Exception as e:
                     print(f"Failed to read from INA260: {e}")
 
-            client.publish(TOPIC_PUB_PARAMS, json.dumps(params_data), retain=True)
-            
-        print(f"MPSAS: {mpsas_msg} | Time: {tsl.get_int_time_ms()}ms | Gain: {tsl.gain} | Interval: {MEASURE_INTERVAL}s")
-        
-        # Write SQM value to JSON file
-        sqm_data = {"AS_MPSAS": float(mpsas_msg)}
-        json_path = "/home/pi/allsky/config/overlay/extra/allskytsl2591SQM.json"
-        
-        # Create directory if it doesn't exist
-        try:
-            os.makedirs(os.path.dirname(json_path), exist_ok=True)
-            # Write atomically so readers (Allsky overlay / publishdata) never
-            # see a zero-byte or partially-written file.
-            tmp_path = f"{json_path}.tmp"
-            with open(tmp_path, 'w') as f:
-                json.dump(sqm_data, f)
-            os.replace(tmp_path, json_path)
+            if RAW_LOG_FILE:
+                log_raw(record, RAW_LOG_FILE)
+
+            mpsas_msg = process_reading(client, record, ina_metrics)
+            print(f"MPSAS: {mpsas_msg} | Time: {tsl.get_int_time_ms()}ms | Gain: {tsl.gain} | Interval: {MEASURE_INTERVAL}s")
+
         except Exception as e:
-            print(f"File IO Error: {e}")
-            
-    except Exception as e:
-        print(f"Error in measurement loop: {e}")
-        
-    sleep(MEASURE_INTERVAL)
\ No newline at end of file
+            print(f"Error in measurement loop: {e}")
+
+        sleep(MEASURE_INTERVAL)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+# Replay recorded raw readings through the main.py pipeline
+# Feeds (timestamp, full, ir, gain, integration, INA260) records from a RAW_LOG_FILE
+# recording through the same computation, publishing and Allsky-writing code as main.py,
+# at N x real time against an in-process broker stand-in. No sensors or broker needed.
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import ina260
+import tsl2591
+import main
+
+# Gaps between records longer than this (seconds) are treated as service restarts
+DEFAULT_MAX_GAP = 6 * main.MEASURE_INTERVAL
+
+class LocalBroker:
+    """
+    In-process stand-in for the MQTT client used by main.process_reading().
+    Keeps retained messages and optionally writes every publish to a JSON lines file.
+    """
+
+    def __init__(self, output_path=None):
+        self.retained = {}
+        self.count = 0
+        self.output = open(output_path, 'w') if output_path else None
+
+    def is_connected(self):
+        return True
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.count += 1
+        if retain:
+            self.retained[topic] = payload
+        if self.output:
+            self.output.write(json.dumps({"topic": topic, "payload": payload, "retain": retain}) + "\n")
+
+    def close(self):
+        if self.output:
+            self.output.close()
+
+def read_records(path):
+    """Yield records from a JSON lines recording, skipping malformed lines"""
+    with open(path) as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Skipping invalid JSON on line {line_no}")
+
+def replay(records, broker, speed, allsky_path, verbose=False, max_gap=DEFAULT_MAX_GAP):
+    """
+    Run records through main.process_reading().
+    Waits (gap between record timestamps, capped at max_gap) / speed between records;
+    speed 0 runs flat out.
+    A gap longer than max_gap seconds is treated as a service restart and resets the
+    INA260 statistics, as happened live. Returns (readings processed, elapsed seconds).
+    """
+    # INA260 statistics rebuilt from the recorded samples, on the recorded clock
+    stats = ina260.PowerStats()
+    processed = 0
+    prev_timestamp = None
+    start = time.monotonic()
+    next_time = start
+
+    for record in records:
+        try:
+            if speed > 0 and prev_timestamp is not None:
+                # Gaps past max_gap are service restarts, not time worth waiting through
+                next_time += min(max(record["timestamp"] - prev_timestamp, 0), max_gap) / speed
+                delay = next_time - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            prev_timestamp = record["timestamp"]
+
+            ina_metrics = None
+            if record.get("ina260"):
+                if stats.last_sample is not None and record["timestamp"] - stats.last_sample[0] > max_gap:
+                    gap = record["timestamp"] - stats.last_sample[0]
+                    print(f"Gap of {gap:.0f}s, treating as a service restart")
+                    stats.reset()
+                stats.add(record["ina260"], timestamp=record["timestamp"], clock=record["timestamp"])
+                ina_metrics = stats.get_metrics(now=record["timestamp"])
+
+            mpsas_msg = main.process_reading(broker, record, ina_metrics, allsky_path)
+            processed += 1
+            if verbose:
+                print(f"MPSAS: {mpsas_msg} | Time: {tsl2591.int_time_ms(record['integration'])}ms | Gain: {record['gain']}")
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            print(f"Skipping invalid record: {e}")
+
+    return processed, time.monotonic() - start
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay recorded PiSQM raw readings through the measurement pipeline")
+    parser.add_argument("recording", help="JSON lines file written via RAW_LOG_FILE in main.py")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="Replay speed as a multiple of real time (default 0 = as fast as possible)")
+    parser.add_argument("--m0", type=float, default=main.M0, help=f"Magnitude zero point (default {main.M0})")
+    parser.add_argument("--ga", type=float, default=main.GA, help=f"Glass attenuation (default {main.GA})")
+    parser.add_argument("--allsky-path", default=os.path.join(tempfile.gettempdir(), "pisqm_replay_allsky.json"),
+                        help="Allsky JSON output file (default in the temp directory)")
+    parser.add_argument("--max-gap", type=float, default=DEFAULT_MAX_GAP,
+                        help=f"Seconds between records treated as a service restart (default {DEFAULT_MAX_GAP})")
+    parser.add_argument("--output", help="Write every published MQTT message to this JSON lines file")
+    parser.add_argument("--verbose", action="store_true", help="Print every reading")
+    return parser.parse_args()
+
+def run():
+    args = parse_args()
+
+    # Calibration under test
+    main.M0 = args.m0
+    main.GA = args.ga
+
+    broker = LocalBroker(args.output)
+    try:
+        processed, elapsed = replay(read_records(args.recording), broker, args.speed,
+                                    args.allsky_path, args.verbose, args.max_gap)
+    except FileNotFoundError as e:
+        print(f"File IO Error: {e}")
+        sys.exit(1)
+    finally:
+        broker.close()
+
+    rate = processed / elapsed if elapsed > 0 else float("inf")
+    print(f"Replayed {processed} readings in {elapsed:.2f}s ({rate:.1f} readings/s), "
+          f"{broker.count} messages published")
+    final_sqm = broker.retained.get(main.TOPIC_PUB)
+    if final_sqm is not None:
+        print(f"Final MPSAS: {final_sqm}")
+
+if __name__ == "__main__":
+    run()
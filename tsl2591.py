@@ -1,8 +1,7 @@
 # TSL2591 light sensor interface for Raspberry Pi
 # Updated with robust Auto-Ranging for high dynamic range (Daylight to ~22 MPSAS)
 
-import time
-import smbus2
+import i2c_bus
 
 VISIBLE = 2
 INFRARED = 1
@@ -56,10 +55,55 @@ GAIN_MED = 0x10   # 25x
 GAIN_HIGH = 0x20  # 428x
 GAIN_MAX = 0x30   # 9876x
 
+def int_time_ms(integration):
+    """Return an INTEGRATIONTIME_* setting in milliseconds"""
+    case_integ = {
+        INTEGRATIONTIME_100MS: 100,
+        INTEGRATIONTIME_200MS: 200,
+        INTEGRATIONTIME_300MS: 300,
+        INTEGRATIONTIME_400MS: 400,
+        INTEGRATIONTIME_500MS: 500,
+        INTEGRATIONTIME_600MS: 600
+    }
+    return case_integ.get(integration, 100)
+
+def calculate_light(full, ir, gain, integration):
+    """
+    Convert raw counts to uW/cm2 for the given gain/time settings.
+    Needs no hardware, so recorded readings can be reprocessed (see replay.py).
+    """
+    if (full >= 0xFFFF) or (ir >= 0xFFFF):
+        # Saturated
+        return 0.0, 0.0
+        
+    atime = float(int_time_ms(integration))
+
+    case_gain = {
+        GAIN_LOW: 1.,
+        GAIN_MED: 24.5,
+        GAIN_HIGH: 400.,
+        GAIN_MAX: 9876.
+    }
+    again = case_gain.get(gain, 24.5)
+
+    # spec sheet: 264.1 counts per uW/cm2 at GAIN_HIGH (400) and 100ms
+    # Formula: counts = (Irradiance) * (Time/100) * (Gain/400) * 264.1
+    # Irradiance = counts / ((Time/100) * (Gain/400) * 264.1)
+    
+    cpuW0 = (atime / 100.0) * (again / 400.0) * 264.1
+    
+    # Avoid division by zero
+    if cpuW0 == 0:
+        return 0.0, 0.0
+
+    fullc = full / cpuW0
+    irc = ir / cpuW0
+    return fullc, irc
+
 class Tsl2591:
     def __init__(self, sensor_id, integration=INTEGRATIONTIME_200MS, gain=GAIN_MED):
         self.sensor_id = sensor_id
-        self.bus = smbus2.SMBus(1)
+        self.bus = i2c_bus.get_bus(1)  # Shared handle, see i2c_bus.py
         self.integration_time = integration
         self.gain = gain
         
@@ -112,62 +156,31 @@ class Tsl2591:
 
     def get_int_time_ms(self):
         """Helper to return integration time in milliseconds"""
-        case_integ = {
-            INTEGRATIONTIME_100MS: 100,
-            INTEGRATIONTIME_200MS: 200,
-            INTEGRATIONTIME_300MS: 300,
-            INTEGRATIONTIME_400MS: 400,
-            INTEGRATIONTIME_500MS: 500,
-            INTEGRATIONTIME_600MS: 600
-        }
-        return case_integ.get(self.integration_time, 100)
+        return int_time_ms(self.integration_time)
 
     def calculate_light(self, full, ir):
         """Convert raw counts to uW/cm2 based on current gain/time settings"""
-        if (full >= 0xFFFF) or (ir >= 0xFFFF):
-            # Saturated
-            return 0.0, 0.0
-            
-        atime = float(self.get_int_time_ms())
-
-        case_gain = {
-            GAIN_LOW: 1.,
-            GAIN_MED: 24.5,
-            GAIN_HIGH: 400.,
-            GAIN_MAX: 9876.
-        }
-        again = case_gain.get(self.gain, 24.5)
-
-        # spec sheet: 264.1 counts per uW/cm2 at GAIN_HIGH (400) and 100ms
-        # Formula: counts = (Irradiance) * (Time/100) * (Gain/400) * 264.1
-        # Irradiance = counts / ((Time/100) * (Gain/400) * 264.1)
-        
-        cpuW0 = (atime / 100.0) * (again / 400.0) * 264.1
-        
-        # Avoid division by zero
-        if cpuW0 == 0:
-            return 0.0, 0.0
-
-        fullc = full / cpuW0
-        irc = ir / cpuW0
-        return fullc, irc
+        return calculate_light(full, ir, self.gain, self.integration_time)
 
     def read_word(self, register):
-        """Read a word from the I2C device"""
-        try:
-            return self.bus.read_word_data(SENSOR_ADDRESS, COMMAND_BIT | register)
-        except Exception as e:
-            print(f"I2C Read Error: {e}")
-            return 0
+        """Read a word from the I2C device (transient errors are retried by the bus)"""
+        return self.bus.read_word_data(SENSOR_ADDRESS, COMMAND_BIT | register)
 
     def advanced_read(self):
         """
         Auto-ranging read function.
         Adjusts gain and integration time to find the best signal.
         Handles extremely bright (saturation) and very dark (noise) conditions.
+        Work deferred on the shared bus runs during the integration waits.
         """
         self.enable()
-        
+        try:
+            return self._auto_range()
+        finally:
+            self.disable()
+
+    def _auto_range(self):
+        """Auto-ranging loop used by advanced_read(), expects the sensor enabled"""
         # Max attempts to find range
         max_attempts = 15
         attempt = 0
@@ -177,7 +190,7 @@ class Tsl2591:
             
             # 1. Wait for integration time + margin
             wait_time = (self.get_int_time_ms() / 1000.0) + 0.12 # 120ms margin
-            time.sleep(wait_time)
+            self.bus.wait(wait_time)
             
             # 2. Read values
             full = self.read_word(REGISTER_CHAN0_LOW)
@@ -232,6 +245,5 @@ class Tsl2591:
 
             # If we are here, the reading is within valid range (200 < full < 60000)
             break
-            
-        self.disable()
+
         return full, ir
\ No newline at end of file